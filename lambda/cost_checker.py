@@ -1,8 +1,112 @@
 import json
 import boto3
+import collections
+import heapq
+import operator
 import os
+import time
+from boto3.dynamodb.conditions import Attr
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
+
+# orjson is faster when it is available in a Lambda layer, json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Cost Explorer has a low request rate limit, so back off adaptively when
+# throttled and keep the connection alive across warm invocations
+CE_CONFIG = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=10
+)
+
+# Fail fast on SNS instead of waiting on botocore's default 60s socket timeouts
+SNS_CONFIG = Config(
+    connect_timeout=2,
+    read_timeout=3,
+    retries={'max_attempts': 2, 'mode': 'adaptive'}
+)
+
+# AWS clients are created once per container and reused across warm invocations
+try:
+    CE = boto3.client('ce', region_name='us-east-1', config=CE_CONFIG)
+    SNS = boto3.client('sns', region_name='us-east-1', config=SNS_CONFIG)
+    DDB_TABLE = boto3.resource('dynamodb', region_name='us-east-1').Table('AWSCostHistory')
+except Exception as e:
+    print(f" Failed to initialize AWS clients: {str(e)}")
+    CE = SNS = DDB_TABLE = None
+
+# A service's cost for one day
+Service = collections.namedtuple('Service', ('name', 'cost'))
+
+# Rule drawn under report headings
+SEPARATOR = '=' * 40
+
+# Notification bodies, filled in with str.format
+REPORT_TEMPLATE = """
+AWS Cost Report - {date}
+{bar}
+
+Total Cost (before credits): ${total:.2f}
+
+{services_block}
+
+{storage_note}
+Note: Costs may take 24-48 hours to appear in Cost Explorer."""
+
+TEST_REPORT_TEMPLATE = """
+ TEST MODE - AWS Cost Report - {date}
+{bar}
+
+ THIS IS SIMULATED DATA FOR TESTING
+
+Total Cost: ${total:.2f}
+
+Top Services:
+{services_block}
+
+{bar}
+{storage_note}
+
+This is test data generated for development.
+Real cost data will appear here once available.
+"""
+
+# DynamoDB stores costs rounded to the cent
+CENTS = Decimal('0.01')
+
+# Services and daily cost ranges used to generate test data
+FAKE_SERVICES = (
+    ('Amazon Elastic Compute Cloud - Compute', 1.0, 3.0),
+    ('Amazon Simple Storage Service', 0.3, 1.2),
+    ('AWS Lambda', 0.05, 0.4),
+    ('Amazon Relational Database Service', 0.5, 2.0),
+    ('Amazon CloudFront', 0.1, 0.6),
+    ('Amazon DynamoDB', 0.05, 0.3),
+    ('Amazon SNS', 0.01, 0.1)
+)
+
+# Stored real rows younger than this are reused instead of calling Cost Explorer
+CACHE_MAX_AGE = timedelta(hours=6)
+
+# Test rows expire after 90 days (TTL must be enabled on the 'ttl' attribute)
+TEST_DATA_TTL = 90 * 86400
+
+# Set SKIP_TEST_WRITES=1 to keep test-mode runs out of DynamoDB
+SKIP_TEST_WRITES = os.environ.get('SKIP_TEST_WRITES') == '1'
+
+# Background workers for network I/O that can overlap other work
+EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Seconds to wait for a background SNS publish before returning
+SNS_PUBLISH_TIMEOUT = 10
 
 def lambda_handler(event, context):
     """
@@ -21,38 +125,244 @@ def lambda_handler(event, context):
     return real_cost_handler(event, context)
 
 
-def save_to_dynamodb(date, total_cost, services, is_test=False):
+def dumps_body(data):
+    """
+    Serialize a response body to a JSON string
+    """
+    if orjson:
+        # The Lambda response itself must be JSON serializable, so keep a str body
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def services_to_dicts(services):
+    """
+    Convert Service records to dicts for the JSON response
+    """
+    return [{'service': svc.name, 'cost': svc.cost} for svc in services]
+
+
+def format_services(services):
+    """
+    Format Service records as a numbered list for notifications
+    """
+    return "\n".join(f"{i}. {svc.name}: ${svc.cost:.2f}" for i, svc in enumerate(services, 1))
+
+
+def save_to_dynamodb(days, is_test=False):
     """
-    Save cost data to DynamoDB
+    Save cost data to DynamoDB.
+    days is a list of (date, total_cost, services, estimated) tuples.
+    Real data always overwrites the stored row so estimated days get
+    refreshed. Test data is only written where no real row exists.
+    Returns True only if every day was written: days with no recorded
+    cost, test rows blocked by real data and test rows skipped by
+    SKIP_TEST_WRITES all make it return False.
     """
+    if is_test and SKIP_TEST_WRITES:
+        print(" Skipping DynamoDB save for test data")
+        return False
+    
+    # Days with no recorded cost are not worth a write
+    recorded = []
+    for day in days:
+        if day[2] or day[1] >= 0.01:
+            recorded.append(day)
+        else:
+            print(f" Skipping DynamoDB save for {day[0]}, no costs recorded")
+    
+    saved_all = len(recorded) == len(days)
+    days = recorded
+    if not days:
+        return False
+    
     try:
-        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-        table = dynamodb.Table('AWSCostHistory')
+        timestamp = datetime.now().isoformat()
         
         # Convert floats to Decimal for DynamoDB
-        item = {
-            'date': str(date),
-            'total_cost': Decimal(str(round(total_cost, 2))),
-            'top_services': [
-                {
-                    'service': svc['service'],
-                    'cost': Decimal(str(round(svc['cost'], 2)))
-                }
-                for svc in services[:10]  # Store top 10 services
-            ],
-            'timestamp': datetime.now().isoformat(),
-            'is_test_data': is_test
-        }
+        items = [
+            {
+                'date': str(date),
+                'total_cost': Decimal(total_cost).quantize(CENTS, rounding=ROUND_HALF_UP),
+                'top_services': [
+                    {
+                        'service': svc.name,
+                        'cost': Decimal(svc.cost).quantize(CENTS, rounding=ROUND_HALF_UP)
+                    }
+                    for svc in services[:10]  # Store top 10 services
+                ],
+                'timestamp': timestamp,
+                'is_test_data': is_test,
+                'estimated': estimated
+            }
+            for date, total_cost, services, estimated in days
+        ]
         
-        table.put_item(Item=item)
-        print(f" Saved to DynamoDB: {date}, ${total_cost:.2f}")
-        return True
+        if is_test:
+            expires_at = int(time.time()) + TEST_DATA_TTL
+            
+            # Test rows must never overwrite real data. BatchWriteItem has no
+            # condition support, so each test row is a conditional put.
+            for item in items:
+                item['ttl'] = expires_at
+                try:
+                    DDB_TABLE.put_item(
+                        Item=item,
+                        ConditionExpression=Attr('date').not_exists() | Attr('is_test_data').eq(True)
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+                    print(f" Real data already in DynamoDB for {item['date']}, test data not saved")
+                    saved_all = False
+                    continue
+                print(f" Saved to DynamoDB: {item['date']}, ${item['total_cost']}")
+            return saved_all
+        
+        if len(items) == 1:
+            DDB_TABLE.put_item(Item=items[0])
+        else:
+            # batch_writer groups puts into 25-item BatchWriteItem calls
+            # and retries any UnprocessedItems
+            with DDB_TABLE.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+        
+        for date, total_cost, services, estimated in days:
+            print(f" Saved to DynamoDB: {date}, ${total_cost:.2f}")
+        return saved_all
         
     except Exception as e:
         print(f" Failed to save to DynamoDB: {str(e)}")
         return False
 
 
+def extract_day_costs(results):
+    """
+    Extract date, total cost, the 10 most expensive services (highest
+    first) and whether the figures are still estimated, from one
+    ResultsByTime entry
+    """
+    report_date = results['TimePeriod']['Start']
+    
+    # Extract total cost
+    total_cost = 0.0
+    if 'Total' in results and 'UnblendedCost' in results['Total']:
+        total_cost = float(results['Total']['UnblendedCost']['Amount'])
+    
+    # Get service breakdown
+    services = []
+    services_append = services.append
+    for group in results.get('Groups', ()):
+        metrics = group.get('Metrics')
+        if metrics is None:
+            continue
+        unblended = metrics.get('UnblendedCost')
+        if unblended is None:
+            continue
+        cost = float(unblended['Amount'])
+        if cost > 0.01:
+            services_append(Service(group['Keys'][0], cost))
+    
+    # Only the top 10 are stored, so select them instead of sorting everything
+    services = heapq.nlargest(10, services, key=operator.attrgetter('cost'))
+    
+    # Cost Explorer keeps revising a day while it is Estimated
+    estimated = results.get('Estimated', True)
+    
+    return report_date, total_cost, services, estimated
+
+
+def load_cached_day(date):
+    """
+    Load a day's real cost data saved to DynamoDB within the last
+    CACHE_MAX_AGE, so repeat runs on the same day skip Cost Explorer.
+    Returns (date, total_cost, services, estimated) or None on a cache miss.
+    Test rows and rows older than CACHE_MAX_AGE are misses.
+    """
+    try:
+        response = DDB_TABLE.get_item(
+            Key={'date': str(date)},
+            ConsistentRead=False
+        )
+    except Exception as e:
+        print(f" Failed to read cache from DynamoDB: {str(e)}")
+        return None
+    
+    item = response.get('Item')
+    if not item or item.get('is_test_data') or 'timestamp' not in item:
+        return None
+    
+    # Estimated days keep changing, so only reuse a recently saved row
+    if datetime.now() - datetime.fromisoformat(item['timestamp']) > CACHE_MAX_AGE:
+        return None
+    
+    # Convert Decimals back to floats
+    services = [
+        Service(svc['service'], float(svc['cost']))
+        for svc in item.get('top_services', [])
+    ]
+    
+    return item['date'], float(item['total_cost']), services, item.get('estimated', True)
+
+
+class SNSPublishError(Exception):
+    """
+    Raised when PublishBatch entries still fail after retrying
+    """
+
+
+def publish_to_sns(topic_arn, messages):
+    """
+    Publish (subject, message) tuples to SNS with PublishBatch,
+    10 entries per call. Entries that failed on the SNS side are retried
+    with exponential backoff; sender faults are not retried.
+    """
+    entries = [
+        {'Id': str(i), 'Subject': subject, 'Message': message}
+        for i, (subject, message) in enumerate(messages)
+    ]
+    attempts = 3
+    
+    for start in range(0, len(entries), 10):
+        pending = entries[start:start + 10]
+        rejected = []
+        
+        for attempt in range(attempts):
+            response = SNS.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=pending
+            )
+            failed = response.get('Failed', [])
+            
+            # Sender faults (bad input) fail the same way on every retry
+            rejected += [f['Id'] for f in failed if f.get('SenderFault')]
+            retry_ids = {f['Id'] for f in failed if not f.get('SenderFault')}
+            pending = [entry for entry in pending if entry['Id'] in retry_ids]
+            
+            if not pending or attempt == attempts - 1:
+                break
+            
+            time.sleep(0.2 * 2 ** attempt)
+        
+        if pending or rejected:
+            raise SNSPublishError(f"SNS publish failed for {len(pending) + len(rejected)} message(s)")
+
+
+def is_sns_error(error):
+    """
+    Check whether an exception was raised by a call to SNS
+    """
+    if isinstance(error, SNSPublishError):
+        return True
+    if isinstance(error, ClientError):
+        return error.operation_name == 'PublishBatch'
+    if isinstance(error, (ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)):
+        # Compare with the client's own endpoint so VPC and custom endpoints match
+        return SNS is not None and str(error.kwargs.get('endpoint_url', '')).startswith(SNS.meta.endpoint_url)
+    return False
+
+
 def real_cost_handler(event, context):
     """
     Fetches real AWS costs from Cost Explorer
@@ -62,126 +372,123 @@ def real_cost_handler(event, context):
     COST_THRESHOLD = 5.0
     SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
     
-    # Initialize clients
-    ce = boto3.client('ce', region_name='us-east-1')
-    sns = boto3.client('sns', region_name='us-east-1')
-    
     # Get date range - last 7 days to ensure we get data
     end_date = datetime.now().date()
     start_date = end_date - timedelta(days=7)
     
-    print(f"Fetching costs from {start_date} to {end_date}")
-    
     try:
-        # Fetch costs
-        response = ce.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            Granularity='DAILY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
-        )
-        
-        print(f" Cost Explorer Response received")
+        # Reuse yesterday's row if an earlier run saved it recently
+        cached_day = load_cached_day(end_date - timedelta(days=1))
         
-        # Check if we have results
-        if 'ResultsByTime' not in response or len(response['ResultsByTime']) == 0:
-            print(" No cost data available yet")
+        if cached_day:
+            print(f" Using cached cost data for {cached_day[0]}")
+            days = [cached_day]
+        else:
+            print(f"Fetching costs from {start_date} to {end_date}")
+            
+            # Fetch costs
+            response = CE.get_cost_and_usage(
+                TimePeriod={
+                    'Start': start_date.isoformat(),
+                    'End': end_date.isoformat()
+                },
+                Granularity='DAILY',
+                Metrics=['UnblendedCost'],
+                GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}],
+                # Drop credits and refunds server-side to keep the payload small
+                Filter={'Not': {'Dimensions': {'Key': 'RECORD_TYPE', 'Values': ['Credit', 'Refund']}}}
+            )
             
-            if SNS_TOPIC_ARN:
-                sns.publish(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Subject="AWS Cost Monitor - No Data Yet",
-                    Message="No cost data available yet. This is normal for new accounts.\n\nCosts typically appear 24-48 hours after resource usage."
-                )
+            print(f" Cost Explorer Response received")
             
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'No cost data available yet'})
-            }
+            # Check if we have results
+            if 'ResultsByTime' not in response or len(response['ResultsByTime']) == 0:
+                print(" No cost data available yet")
+                
+                if SNS_TOPIC_ARN:
+                    publish_to_sns(SNS_TOPIC_ARN, [(
+                        "AWS Cost Monitor - No Data Yet",
+                        "No cost data available yet. This is normal for new accounts.\n\nCosts typically appear 24-48 hours after resource usage."
+                    )])
+                
+                return {
+                    'statusCode': 200,
+                    'body': dumps_body({'message': 'No cost data available yet'})
+                }
+            
+            # Extract every day in the range, most recent day is reported
+            days = [extract_day_costs(results) for results in response['ResultsByTime']]
         
-        # Get the most recent day's data
-        results = response['ResultsByTime'][-1]
-        report_date = results['TimePeriod']['Start']
+        report_date, total_cost, services, _ = days[-1]
+        top_5 = services[:5]
         
         print(f"Processing data for: {report_date}")
         
-        # Extract total cost
-        total_cost = 0.0
-        if 'Total' in results and 'UnblendedCost' in results['Total']:
-            total_cost = float(results['Total']['UnblendedCost']['Amount'])
-        
-        # Get service breakdown
-        services = []
-        if 'Groups' in results:
-            for group in results['Groups']:
-                service_name = group['Keys'][0]
-                if 'Metrics' in group and 'UnblendedCost' in group['Metrics']:
-                    cost = float(group['Metrics']['UnblendedCost']['Amount'])
-                    if cost > 0.01:
-                        services.append({
-                            'service': service_name,
-                            'cost': cost
-                        })
-        
-        services.sort(key=lambda x: x['cost'], reverse=True)
-        top_5 = services[:5]
-        
-        # Save to DynamoDB
-        save_to_dynamodb(report_date, total_cost, services, is_test=False)
+        # Save all days to DynamoDB in one batch, in the background so the
+        # write overlaps message building
+        ddb_future = None
+        if not cached_day:
+            ddb_future = EXECUTOR.submit(save_to_dynamodb, days, is_test=False)
         
         # Prepare message
-        message = f"""
-AWS Cost Report - {report_date}
-{'='*40}
-
-Total Cost: ${total_cost:.2f}
-
-"""
-        
         if top_5:
-            message += "Top Services:\n"
-            for i, svc in enumerate(top_5, 1):
-                message += f"{i}. {svc['service']}: ${svc['cost']:.2f}\n"
+            services_block = "Top Services:\n" + format_services(top_5)
         else:
-            message += "No individual service costs recorded.\n"
-        
-        message += f"\n💾 Cost data stored in DynamoDB"
-        message += f"\nNote: Costs may take 24-48 hours to appear in Cost Explorer."
+            services_block = "No individual service costs recorded."
         
         # Determine if alert needed
         alert_triggered = total_cost > COST_THRESHOLD
         
         if alert_triggered:
             subject = f" AWS Cost Alert: ${total_cost:.2f}"
-            message = f" ALERT: Daily cost exceeded ${COST_THRESHOLD}\n\n" + message
         else:
             subject = f"AWS Daily Cost Report: ${total_cost:.2f}"
         
-        # Send SNS notification
+        # The message reports whether the data was stored, so wait for the write.
+        # A cached day is already in DynamoDB.
+        saved = ddb_future.result() if ddb_future else True
+        
+        if saved:
+            storage_note = "💾 Cost data stored in DynamoDB"
+        else:
+            storage_note = "💾 Cost data not fully stored in DynamoDB"
+        
+        message = REPORT_TEMPLATE.format(
+            date=report_date,
+            bar=SEPARATOR,
+            total=total_cost,
+            services_block=services_block,
+            storage_note=storage_note
+        )
+        
+        if alert_triggered:
+            message = f" ALERT: Daily cost exceeded ${COST_THRESHOLD}\n\n" + message
+        
+        messages = [(subject, message)]
+        
+        # Send SNS notification in the background while the report is logged
+        sns_future = None
         if SNS_TOPIC_ARN:
+            sns_future = EXECUTOR.submit(publish_to_sns, SNS_TOPIC_ARN, messages)
+        
+        print(message)
+        
+        # Wait for delivery before the container can be frozen
+        if sns_future:
             try:
-                sns.publish(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Subject=subject,
-                    Message=message
-                )
+                sns_future.result(timeout=SNS_PUBLISH_TIMEOUT)
                 print(f" Notification sent to SNS")
             except Exception as sns_error:
                 print(f" Failed to send SNS: {str(sns_error)}")
         
-        print(message)
-        
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': dumps_body({
                 'date': report_date,
                 'total_cost': total_cost,
-                'top_services': top_5,
+                'top_services': services_to_dicts(top_5),
                 'alert_sent': alert_triggered,
-                'saved_to_db': True
+                'saved_to_db': saved
             })
         }
         
@@ -189,19 +496,19 @@ Total Cost: ${total_cost:.2f}
         error_msg = f" Error: {str(e)}"
         print(error_msg)
         
-        if SNS_TOPIC_ARN:
+        # Don't wait on SNS again if SNS is what failed
+        if SNS_TOPIC_ARN and not is_sns_error(e):
             try:
-                sns.publish(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Subject=" AWS Cost Monitor Error",
-                    Message=f"Error occurred:\n\n{str(e)}"
-                )
+                publish_to_sns(SNS_TOPIC_ARN, [(
+                    " AWS Cost Monitor Error",
+                    f"Error occurred:\n\n{str(e)}"
+                )])
             except:
                 pass
         
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': dumps_body({'error': str(e)})
         }
 
 
@@ -216,53 +523,38 @@ def test_mode_handler(event, context):
     print("="*50)
     
     SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
-    sns = boto3.client('sns', region_name='us-east-1')
     
     # Generate realistic fake costs
     fake_services = [
-        {'service': 'Amazon Elastic Compute Cloud - Compute', 'cost': random.uniform(1.0, 3.0)},
-        {'service': 'Amazon Simple Storage Service', 'cost': random.uniform(0.3, 1.2)},
-        {'service': 'AWS Lambda', 'cost': random.uniform(0.05, 0.4)},
-        {'service': 'Amazon Relational Database Service', 'cost': random.uniform(0.5, 2.0)},
-        {'service': 'Amazon CloudFront', 'cost': random.uniform(0.1, 0.6)},
-        {'service': 'Amazon DynamoDB', 'cost': random.uniform(0.05, 0.3)},
-        {'service': 'Amazon SNS', 'cost': random.uniform(0.01, 0.1)}
+        Service(service, random.uniform(low, high))
+        for service, low, high in FAKE_SERVICES
     ]
     
     # Calculate total
-    total_cost = sum(svc['cost'] for svc in fake_services)
+    total_cost = sum(svc.cost for svc in fake_services)
     
     # Sort by cost
-    fake_services.sort(key=lambda x: x['cost'], reverse=True)
+    fake_services = heapq.nlargest(10, fake_services, key=operator.attrgetter('cost'))
     
     # Get today's date
     today = datetime.now().date()
     
     # Save to DynamoDB
-    save_to_dynamodb(today, total_cost, fake_services, is_test=True)
-    
-    # Build message
-    message = f"""
- TEST MODE - AWS Cost Report - {today}
-{'='*40}
-
- THIS IS SIMULATED DATA FOR TESTING
-
-Total Cost: ${total_cost:.2f}
-
-Top Services:
-"""
+    saved = save_to_dynamodb([(today, total_cost, fake_services, False)], is_test=True)
     
-    for i, svc in enumerate(fake_services[:5], 1):
-        message += f"{i}. {svc['service']}: ${svc['cost']:.2f}\n"
+    if saved:
+        storage_note = " Test data stored in DynamoDB"
+    else:
+        storage_note = " Test data not stored in DynamoDB"
     
-    message += f"""
-{'='*40}
- Test data stored in DynamoDB
-
-This is test data generated for development.
-Real cost data will appear here once available.
-"""
+    # Build message
+    message = TEST_REPORT_TEMPLATE.format(
+        date=today,
+        bar=SEPARATOR,
+        total=total_cost,
+        services_block=format_services(fake_services[:5]),
+        storage_note=storage_note
+    )
     
     # Determine subject
     COST_THRESHOLD = 5.0
@@ -274,11 +566,7 @@ Real cost data will appear here once available.
     # Send notification
     if SNS_TOPIC_ARN:
         try:
-            sns.publish(
-                TopicArn=SNS_TOPIC_ARN,
-                Subject=subject,
-                Message=message
-            )
+            publish_to_sns(SNS_TOPIC_ARN, [(subject, message)])
             print(" Test notification sent to SNS")
         except Exception as e:
             print(f" Failed to send test notification: {str(e)}")
@@ -287,12 +575,12 @@ Real cost data will appear here once available.
     
     return {
         'statusCode': 200,
-        'body': json.dumps({
+        'body': dumps_body({
             'test_mode': True,
             'date': str(today),
             'total_cost': total_cost,
-            'top_services': fake_services[:5],
-            'saved_to_db': True,
-            'message': 'Test data generated and stored'
+            'top_services': services_to_dicts(fake_services[:5]),
+            'saved_to_db': saved,
+            'message': 'Test data generated and stored' if saved else 'Test data generated, not stored'
         })
     }
\ No newline at end of file